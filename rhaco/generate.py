@@ -1,20 +1,50 @@
 import mbuild as mb
 import numpy as np
 import argparse
-import copy
 import os
 import re
 import zlib
 import base64
+import io
+import multiprocessing
 from rhaco.definitions import PDB_LIBRARY, FF_LIBRARY, FOYER_FF_FORMATS, EXTERNAL_FF_FORMATS, ATOM_MASSES
 import xml.etree.cElementTree as ET
+try:
+    # lxml does the serialization in C, which is much faster than
+    # ElementTree when writing out large morphologies
+    from lxml import etree as xml_writer
+except ImportError:
+    xml_writer = ET
 from collections import OrderedDict
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is only used to speed up fix_images, so if it isn't installed
+    # just run the plain Python versions of the functions instead
+    def njit(*args, **kwargs):
+        def decorator(function):
+            return function
+        return decorator
 
 
 # Conversion factors
 G_TO_AMU = 6.0222E23
 CM_TO_NM = 1.0000E07
 
+# The number of unit cells along each side of the tiles that the crystal
+# surface is split into when adding the bonds between cells
+BOND_TILE_SIZE = 8
+
+# The xml tags that hold per-atom 3-vectors, with the hoomd_morphology
+# attribute and the dtype that they are stored as. These are kept as (N, 3)
+# NumPy arrays, rather than as lists of strings in raw_data.
+ARRAY_TAGS = {'position': ('positions', float),
+              'image': ('images', int),
+              'velocity': ('velocities', float)}
+
 
 # Set the defaults for all the required arguments
 defaults_dict = {'stoichiometry': {'Mo': 1, 'V': 0.15, 'Nb': 0.13, 'Te': 0.12},
@@ -27,6 +57,9 @@ defaults_dict = {'stoichiometry': {'Mo': 1, 'V': 0.15, 'Nb': 0.13, 'Te': 0.12},
                  'reactant_density': None,
                  'forcefield': None,
                  'integrate_crystal': False}
+# The (argument name, default value) pairs in the order that any non-default
+# arguments appear in the output file name
+SORTED_DEFAULTS = tuple(sorted(defaults_dict.items()))
 
 
 def split_argument_into_dictionary(argument):
@@ -59,85 +92,157 @@ def split_argument_into_dictionary(argument):
 
 class crystal_unit_cell(mb.Compound):
     # This class will contain the unit cell for manipulation and replication
-    def __init__(self, template, stoichiometry_dict):
+    def __init__(self, template):
         # Call the mb.Compound initialisation
         super().__init__()
         # Load the unit cell
         mb.load(os.path.join(PDB_LIBRARY, template), compound=self)
+
+    # atom_types and atom_probs are the first two outputs of
+    # calculate_probabilities(stoichiometry_dict), which are the same for
+    # every cell in the surface and so are only calculated once by the caller
+    # random_state can be given so that cells created in different processes
+    # don't all make the same random choices
+    def assign_atom_types(self, atom_types, atom_probs,
+                          random_state=np.random):
         # Replacable atoms in the matrix are assigned as type `X'
-        # Note: In both Py2 and Py3, subsequent calls to keys() and values()
-        # with no intervening modifications will directly correspond
-        # \cite{PyDocumentation}
-        atom_types, atom_probs, _ = calculate_probabilities(stoichiometry_dict)
-        for particle in self.particles():
-            if particle.name == 'X':
-                # `Randomly' select an atom type based on the biases given in
-                # stoichiometry_dict
-                particle.name = np.random.choice(atom_types, p=atom_probs)
+        replaceable_particles = [particle for particle in self.particles()
+                                 if particle.name == 'X']
+        # `Randomly' select all of the atom types at once based on the biases
+        # given in the stoichiometry
+        new_names = random_state.choice(atom_types,
+                                        size=len(replaceable_particles),
+                                        p=atom_probs)
+        for particle, new_name in zip(replaceable_particles, new_names):
+            particle.name = str(new_name)
         # # Check all the 'X' atom_types got updated
         # assert('X' not in [particle.name for particle in self.particles()])
 
 
+# Each worker process in the unit cell pool loads its own copy of the
+# template, so that it only has to be sent to the worker once
+worker_template_cell = None
+
+
+def initialise_unit_cell_worker(template):
+    global worker_template_cell
+    worker_template_cell = crystal_unit_cell(template)
+
+
+def create_unit_cell(cell_arguments):
+    atom_types, atom_probs, seed = cell_arguments
+    unit_cell = mb.clone(worker_template_cell)
+    unit_cell.assign_atom_types(atom_types, atom_probs,
+                                random_state=np.random.RandomState(seed))
+    return unit_cell
+
+
 class crystal_surface(mb.Compound):
     # This class will describe the surface and consist of several
     # crystal_unit_cell instances in a specified dimension
     # Default stoichiometry found in: Nanostructured Catalysts: Selective
     # Oxidations (Hess and Schl\"ogl, 2011, RSC)
     def __init__(self, surface_dimensions, template, stoichiometry_dict,
-                 crystal_bonds, x_extent, y_extent, z_extent):
+                 crystal_bonds, x_extent, y_extent, z_extent, n_processes=1):
         # Call the mb.Compound initialisation
         super().__init__()
+        # Note: In both Py2 and Py3, subsequent calls to keys() and values()
+        # with no intervening modifications will directly correspond
+        # \cite{PyDocumentation}
+        atom_types, atom_probs, _ = calculate_probabilities(stoichiometry_dict)
+        # The template is only loaded once, and then each unit cell is cloned
+        # from it. The cells are all created at the origin, and then translated
+        # into place together at the end
+        template_cell = crystal_unit_cell(template)
+        template_xyz = template_cell.xyz
+        # The unit cells don't depend on each other, so they can all be
+        # created up front (in parallel if requested) before they are added to
+        # the surface and bonded together
+        n_cells = int(np.prod(surface_dimensions))
+        if (n_processes > 1) and (n_cells > 1):
+            print("Creating", n_cells, "unit cells using", n_processes,
+                  "processes...")
+            # Draw a seed for each cell here, so that the cells are still
+            # reproducible from the main process' random state
+            seeds = np.random.randint(0, 2**31 - 1, size=n_cells)
+            with multiprocessing.Pool(n_processes,
+                                      initializer=initialise_unit_cell_worker,
+                                      initargs=(template,)) as pool:
+                unit_cells = pool.map(create_unit_cell,
+                                      [(atom_types, atom_probs, seed)
+                                       for seed in seeds])
+        else:
+            unit_cells = []
+            for _ in range(n_cells):
+                unit_cell = mb.clone(template_cell)
+                unit_cell.assign_atom_types(atom_types, atom_probs)
+                unit_cells.append(unit_cell)
+        unit_cells = iter(unit_cells)
         # OUTER LOOP: Create multiple layers based on the input dimensions
         for z_repeat in range(surface_dimensions[2]):
             # MIDDLE LOOP: Multiply up each x_row to create as many y repeats
             # as specified
-            # complete_cell_matrix is required to keep track of new bonds
-            # across diagonal elements
+            # complete_cell_matrix is required to keep track of the bonds
+            # between neighbouring cells, and is indexed [y][x]
             complete_cell_matrix = []
-            previous_row = None
             for y_repeat in range(surface_dimensions[1]):
                 current_row = []
                 # INNER LOOP: First, create as many x repeats as specified
                 # Note: Each cell has 159 atoms in it
-                previous_cell = None
                 for x_repeat in range(surface_dimensions[0]):
                     print("\rAdding " + repr([x_repeat, y_repeat, z_repeat])
                           + " to system...", end=" ")
-                    current_cell = crystal_unit_cell(template,
-                                                     stoichiometry_dict)
+                    current_cell = next(unit_cells)
                     current_row.append(current_cell)
-                    current_cell.translate([x_repeat * x_extent,
-                                            y_repeat * y_extent,
-                                            z_repeat * z_extent])
                     self.add(current_cell)
-                    if crystal_bonds and (previous_cell is not None):
-                        self.add_x_connecting_bonds(previous_cell,
-                                                    current_cell)
-                    previous_cell = current_cell
-                if crystal_bonds and (previous_row is not None):
-                    for cell_ID, current_cell_y in enumerate(current_row):
-                        previous_cell_y = previous_row[cell_ID]
-                        self.add_y_connecting_bonds(previous_cell_y,
-                                                    current_cell_y)
                 complete_cell_matrix.append(current_row)
-                previous_row = current_row
-            # Now that the cell_matrix is complete for this layer, there might
-            # be a few more bonds to add in.
-            # Go across all rows first
-            for y_coord in range(surface_dimensions[1]):
-                # Now each column
-                for x_coord in range(surface_dimensions[0]):
-                    # Bonds located across the diagonals (i.e. [0, 0] bonded
-                    # to [1, 1]; [0, 1] bonded to [1, 2] etc.)
-                    if crystal_bonds and (x_coord + 1 < surface_dimensions[0])\
-                       and (y_coord + 1 < surface_dimensions[1]):
-                        first_cell = complete_cell_matrix[x_coord][y_coord]
-                        second_cell = complete_cell_matrix[
-                            x_coord + 1][y_coord + 1]
-                        self.add_diagonal_connecting_bonds(first_cell,
-                                                           second_cell)
+            # Now that the cell_matrix is complete for this layer, add the
+            # bonds between the cells
+            if crystal_bonds:
+                self.add_connecting_bonds(complete_cell_matrix)
+        if self.n_particles > 0:
+            # The cells were added x fastest, then y, then z, so build the
+            # offsets for each cell in the same order and then shift every
+            # particle in the surface with a single update
+            z_IDs, y_IDs, x_IDs = np.mgrid[0:surface_dimensions[2],
+                                           0:surface_dimensions[1],
+                                           0:surface_dimensions[0]]
+            cell_offsets = np.stack([x_IDs * x_extent, y_IDs * y_extent,
+                                     z_IDs * z_extent], axis=-1).reshape(-1, 3)
+            self.xyz = (template_xyz[np.newaxis, :, :]
+                        + cell_offsets[:, np.newaxis, :]).reshape(-1, 3)
         print()
 
+    def add_connecting_bonds(self, cell_matrix):
+        # Rather than sweeping over the whole layer once for each kind of
+        # bond, work through the layer in BOND_TILE_SIZE x BOND_TILE_SIZE
+        # tiles, and add all of the x, y and diagonal bonds for each cell in
+        # the tile together so that the same cells are revisited while they
+        # are still in cache
+        n_y_cells = len(cell_matrix)
+        n_x_cells = len(cell_matrix[0])
+        for y_tile in range(0, n_y_cells, BOND_TILE_SIZE):
+            for x_tile in range(0, n_x_cells, BOND_TILE_SIZE):
+                for y_coord in range(y_tile, min(y_tile + BOND_TILE_SIZE,
+                                                 n_y_cells)):
+                    for x_coord in range(x_tile, min(x_tile + BOND_TILE_SIZE,
+                                                     n_x_cells)):
+                        current_cell = cell_matrix[y_coord][x_coord]
+                        if x_coord > 0:
+                            self.add_x_connecting_bonds(
+                                cell_matrix[y_coord][x_coord - 1],
+                                current_cell)
+                        if y_coord > 0:
+                            self.add_y_connecting_bonds(
+                                cell_matrix[y_coord - 1][x_coord],
+                                current_cell)
+                        # Bonds located across the diagonals (i.e. [0, 0]
+                        # bonded to [1, 1]; [0, 1] bonded to [1, 2] etc.)
+                        if (x_coord > 0) and (y_coord > 0):
+                            self.add_diagonal_connecting_bonds(
+                                cell_matrix[y_coord - 1][x_coord - 1],
+                                current_cell)
+
     def add_x_connecting_bonds(self, cell1, cell2):
         self.add_bond([cell1[60], cell2[21]])
         self.add_bond([cell1[137], cell2[13]])
@@ -172,8 +277,8 @@ class crystal_system(mb.Compound):
         super().__init__()
         # Firstly, get the current COM positions for each plane. This will be
         # important later
-        top_COM = copy.deepcopy(top_crystal.pos)
-        bottom_COM = copy.deepcopy(bottom_crystal.pos)
+        top_COM = np.array(top_crystal.pos, copy=True)
+        bottom_COM = np.array(bottom_crystal.pos, copy=True)
         # Then, center both crystals according to their center of geometry
         # (we don't care about masses here)
         top_crystal.translate(-top_crystal.pos)
@@ -220,6 +325,25 @@ class mbuild_template(mb.Compound):
         return mass
 
 
+class hoomd_morphology(object):
+    # This class holds a HOOMD xml morphology. The outer root and config
+    # layers, the per-atom arrays in ARRAY_TAGS, the bonds and the box are
+    # kept as attributes. Every other child of config is kept in raw_data,
+    # which has the keys tag + '_attrib' and tag + '_text'.
+    # child_tags lists the tags of all of the children of config, in the
+    # order that they should be written out.
+    __slots__ = ['root_tag', 'root_attrib', 'root_text', 'config_tag',
+                 'config_attrib', 'config_text', 'positions', 'images',
+                 'velocities', 'bonds', 'box', 'raw_data', 'child_tags']
+
+    def __init__(self):
+        for attribute in self.__slots__:
+            setattr(self, attribute, None)
+        self.raw_data = OrderedDict()
+        self.child_tags = []
+        self.bonds = np.zeros((0, 2), dtype=int)
+
+
 def parse_forcefields(forcefield_string):
     PERMITTED_FF_FORMATS = FOYER_FF_FORMATS + EXTERNAL_FF_FORMATS
     foyer_forcefield_list = []
@@ -317,16 +441,83 @@ def parse_reactant_positions(position_string):
     return position_coords
 
 
+def pack_reactant(compounds, n_compounds, box):
+    # PACKMOL is only needed if there is more than one kind of reactant
+    # molecule, or if the molecules won't fit on a grid in the box
+    if len(compounds) == 1:
+        reactant = fill_box_on_grid(compounds[0], n_compounds[0], box)
+        if reactant is not None:
+            return reactant
+    return mb.packing.fill_box(compounds, n_compounds, box,
+                               seed=np.random.randint(0, 2**31 - 1))
+
+
+def fill_box_on_grid(compound, n_compounds, box, overlap=0.2):
+    # Place n_compounds copies of the compound at randomly-jittered points on
+    # a grid inside the box, keeping at least `overlap' nm (the same as the
+    # default packmol tolerance) between all of the molecules, and between the
+    # molecules and the walls of the box.
+    # Returns None if the molecules don't fit on the grid, so that the caller
+    # can fall back to packmol.
+    if n_compounds < 1:
+        return None
+    box_lengths = np.array(box.maxs - box.mins, dtype=float)
+    # A flat box has no volume to put a grid in (and would make the grid
+    # spacing below non-finite), so leave it to packmol
+    if np.any(box_lengths <= 0):
+        return None
+    # Each molecule already keeps overlap / 2 from the edges of its grid cell,
+    # so lay the grid over the box shrunk by another overlap / 2 on each side
+    # to keep the full overlap from the walls
+    grid_mins = box.mins + overlap / 2.0
+    grid_lengths = box_lengths - overlap
+    if np.any(grid_lengths <= 0):
+        return None
+    compound_xyz = compound.xyz
+    compound_lo = np.min(compound_xyz, axis=0)
+    compound_hi = np.max(compound_xyz, axis=0)
+    compound_extent = compound_hi - compound_lo
+    # Centre the compound's bounding box on the origin
+    compound_xyz = compound_xyz - (compound_hi + compound_lo) / 2.0
+    # Aim for cubic grid cells, and then add rows along whichever axis has the
+    # longest cells until there are enough grid points
+    grid_spacing = (np.prod(grid_lengths) / n_compounds)**(1.0 / 3.0)
+    grid_shape = np.maximum(1, np.floor(grid_lengths
+                                        / grid_spacing)).astype(int)
+    while np.prod(grid_shape) < n_compounds:
+        grid_shape[np.argmax(grid_lengths / grid_shape)] += 1
+    cell_lengths = grid_lengths / grid_shape
+    free_space = cell_lengths - compound_extent - overlap
+    if np.any(free_space < 0):
+        return None
+    # Pick which grid points to use at random, so that any gaps are spread
+    # out through the box
+    grid_points = np.random.choice(np.prod(grid_shape), n_compounds,
+                                   replace=False)
+    grid_IDs = np.stack(np.unravel_index(grid_points, grid_shape), axis=-1)
+    centres = (grid_mins + (grid_IDs + 0.5) * cell_lengths
+               + np.random.uniform(-free_space / 2.0, free_space / 2.0,
+                                   size=(n_compounds, 3)))
+    filled_box = mb.Compound()
+    for _ in range(n_compounds):
+        filled_box.add(mb.clone(compound))
+    filled_box.xyz = (compound_xyz[np.newaxis, :, :]
+                      + centres[:, np.newaxis, :]).reshape(-1, 3)
+    return filled_box
+
+
 def create_morphology(args):
     output_file = create_output_file_name(args)
     print("Generating first surface (bottom)...")
     surface1 = crystal_surface(args.dimensions, args.template,
                                args.stoichiometry, args.crystal_bonds,
-                               args.crystal_x, args.crystal_y, args.crystal_z)
+                               args.crystal_x, args.crystal_y, args.crystal_z,
+                               n_processes=args.n_processes)
     print("Generating second surface (top)...")
     surface2 = crystal_surface(args.dimensions, args.template,
                                args.stoichiometry, args.crystal_bonds,
-                               args.crystal_x, args.crystal_y, args.crystal_z)
+                               args.crystal_x, args.crystal_y, args.crystal_z,
+                               n_processes=args.n_processes)
     # Now create the system by combining the two surfaces
     system = crystal_system(surface1, surface2, args.crystal_separation)
     # Get the crystal IDs because we're going to need them later so that HOOMD
@@ -334,8 +525,15 @@ def create_morphology(args):
     crystal_IDs = range(system.n_particles)
     # Now we can populate the box with reactant
     print("Surfaces generated. Generating reactant...")
-    reactant_components, reactant_probs, reactant_masses = calculate_probabilities(
-        args.reactant_composition, ratio_type='number')
+    reactant_components, reactant_probs, _ = calculate_probabilities(
+        args.reactant_composition)
+    # Load each reactant template once, and reuse it for the masses and for
+    # every box (or position) that the reactant is placed in
+    reactant_templates = [mbuild_template(reactant_molecule) for
+                          reactant_molecule in reactant_components]
+    reactant_masses = {reactant_molecule: reactant_template.mass for
+                       reactant_molecule, reactant_template in
+                       zip(reactant_components, reactant_templates)}
     # Define the regions that the hydrocarbons can go in, so we don't end
     # up with them between layers
     box_top = mb.Box(mins=[-(args.crystal_x * args.dimensions[0]) / 2.0,
@@ -385,31 +583,31 @@ def create_morphology(args):
             print("-rp --reactant_position flag has been specified with length",
                   len(args.reactant_position), "but", str(number_of_reactant_mols),
                   "reactant molecules have been requested!")
-            print("Ignoring specified positions and using packmol to randomly place reactant.")
+            print("Ignoring specified positions. The reactant will be placed on a"
+                  " jittered grid if there is only one species and it fits,"
+                  " otherwise packmol will randomly place it.")
             args.reactant_position = None
         else:
             for _, position in enumerate(args.reactant_position):
-                nanoparticle = mbuild_template(reactant_components[0])
+                nanoparticle = mb.clone(reactant_templates[0])
                 nanoparticle.translate_to(np.array(position))
                 system.add(nanoparticle)
     if args.reactant_position is None:
-        # Randomly place reactants using packmol
+        # Randomly place reactants, on a grid if possible or else using packmol
         if number_of_reactant_mols == 1:
             # Only 1 molecule to place, so put it on top of the crystals
-            reactant_top = mb.packing.fill_box(mbuild_template(reactant_components[0]), 1, box_top, seed=np.random.randint(0, 2**31 - 1))
+            reactant_top = pack_reactant([reactant_templates[0]], [1], box_top)
             system.add(reactant_top)
         elif number_of_reactant_mols > 1:
-            reactant_compounds = []
+            # Both boxes are packed from the same template compounds
+            reactant_compounds = reactant_templates
             n_compounds = []
             for compound_index, reactant_molecule in enumerate(reactant_components):
-                reactant_compounds.append(mbuild_template(reactant_molecule))
                 n_compounds.append(int(np.round(np.round(
                     reactant_probs[compound_index] * number_of_reactant_mols) / 2.0)))
-            reactant_top = mb.packing.fill_box(reactant_compounds, n_compounds, box_top,
-                                          seed=np.random.randint(0, 2**31 - 1))
-            reactant_bottom = mb.packing.fill_box(reactant_compounds, n_compounds,
-                                             box_bottom,
-                                             seed=np.random.randint(0, 2**31 - 1))
+            reactant_top = pack_reactant(reactant_compounds, n_compounds, box_top)
+            reactant_bottom = pack_reactant(reactant_compounds, n_compounds,
+                                            box_bottom)
             system.add(reactant_top)
             system.add(reactant_bottom)
 
@@ -448,8 +646,9 @@ def create_morphology(args):
         # forcefield input files it will need to care about (if they aren't
         # already covered by Foyer).
         if len(args.forcefield[1]) > 0:
-            morphology["external_forcefields_attrib"] = {"num": str(len(args.forcefield[1]))}
-            morphology["external_forcefields_text"] = args.forcefield[1]
+            morphology.child_tags.append("external_forcefields")
+            morphology.raw_data["external_forcefields_attrib"] = {"num": str(len(args.forcefield[1]))}
+            morphology.raw_data["external_forcefields_text"] = args.forcefield[1]
     # Identify the crystal atoms in the system by renaming their type to
     # X_<PREVIOUS ATOM TYPE> so we know not to integrate them in HOOMD
     if args.integrate_crystal is False:
@@ -458,184 +657,239 @@ def create_morphology(args):
     print("Output generated. Exitting...")
 
 
-def check_bonds(morphology, bond_dict, box_dims):
-    for bond in morphology['bond_text']:
-        posn1 = np.array(list(map(float,
-                                  morphology['position_text'][int(bond[1])])))
-        + (np.array(list(map(float, morphology['image_text'][int(bond[1])])))
-           * box_dims)
-        posn2 = np.array(list(map(float,
-                                  morphology['position_text'][int(bond[2])])))
-        + (np.array(list(map(float, morphology['image_text'][int(bond[2])])))
-           * box_dims)
-        delta_position = posn1 - posn2
-        out_of_range = [np.abs(delta_position[axis]) > box_dims[axis] / 2.0
-                        for axis in range(3)]
-        if any(out_of_range):
-            print("Periodic bond found:", bond, "because delta_position =",
-                  delta_position, ">=", box_dims, "/ 2.0")
-            morphology = move_bonded_atoms(bond[1], morphology, bond_dict,
-                                           box_dims)
+def check_bonds(morphology, bond_indptr, bond_indices):
+    if len(morphology.bonds) == 0:
+        return morphology
+    atom_positions = morphology.positions
+    atom_images = morphology.images
+    box_dims = morphology.box
+    bonds = morphology.bonds
+    # Find the bonds that span more than half the box along any axis in one go
+    delta_positions = ((atom_positions[bonds[:, 0]]
+                        - atom_positions[bonds[:, 1]])
+                       + ((atom_images[bonds[:, 0]] - atom_images[bonds[:, 1]])
+                          * box_dims))
+    periodic_bonds = np.where(np.any(np.abs(delta_positions) > box_dims / 2.0,
+                                     axis=1))[0]
+    if len(periodic_bonds) == 0:
+        return morphology
+    # Split the box into octants about its centre, and count how many atoms of
+    # each molecule are in each octant. When a molecule straddles one or more
+    # faces of the box, its most-populated octant is the one it mostly sits in.
+    molecule_IDs = get_molecule_IDs(bond_indptr, bond_indices)
+    atom_octants = (atom_positions > 0.0).astype(int).dot([1, 2, 4])
+    octant_keys = molecule_IDs * 8 + atom_octants
+    octant_counts = np.bincount(octant_keys, minlength=8 * (
+        np.max(molecule_IDs) + 1)).reshape(-1, 8)
+    # The first atom of each (molecule, octant) pair that has any atoms in it
+    occupied_keys, first_atoms = np.unique(octant_keys, return_index=True)
+    fixed_molecules = set()
+    for bond_ID in periodic_bonds:
+        print("Periodic bond found:",
+              morphology.raw_data['bond_text'][bond_ID],
+              "because delta_position =", delta_positions[bond_ID], ">=",
+              box_dims, "/ 2.0")
+        molecule_ID = molecule_IDs[bonds[bond_ID, 0]]
+        # A single traversal fixes every periodic bond in the molecule
+        if molecule_ID in fixed_molecules:
+            continue
+        fixed_molecules.add(molecule_ID)
+        # Start from an atom in the molecule's most-populated octant. That
+        # atom doesn't move along any axis, and neither do the atoms joined
+        # to it without crossing a box face. Every other atom in the
+        # molecule is moved onto the periodic image next to them.
+        majority_key = molecule_ID * 8 + np.argmax(octant_counts[molecule_ID])
+        start_atom = first_atoms[np.searchsorted(occupied_keys, majority_key)]
+        morphology.positions = move_bonded_atoms(
+            start_atom, atom_positions, bond_indptr, bond_indices, box_dims)
     return morphology
 
 
+def get_molecule_IDs(bond_indptr, bond_indices):
+    # Label each atom with the ID of the molecule (connected component of the
+    # bond graph) that it belongs to
+    n_atoms = len(bond_indptr) - 1
+    bond_graph = csr_matrix((np.ones(len(bond_indices)), bond_indices,
+                             bond_indptr), shape=(n_atoms, n_atoms))
+    _, molecule_IDs = connected_components(bond_graph, directed=False)
+    return molecule_IDs
+
+
 def zero_out_images(morphology):
-    morphology['image_text'] = [['0', '0', '0']]\
-        * len(morphology['position_text'])
-    morphology['image_attrib'] = {'num': morphology['position_attrib']['num']}
+    morphology.images = np.zeros_like(morphology.positions, dtype=int)
+    if 'image' not in morphology.child_tags:
+        morphology.child_tags.append('image')
+    morphology.raw_data['image_attrib'] = {
+        'num': morphology.raw_data['position_attrib']['num']}
     return morphology
 
 
-def get_bond_dict(morphology):
-    bond_dict = {atom_id: [] for atom_id, atom_type in
-                 enumerate(morphology['type_text'])}
-    for bond in morphology['bond_text']:
-        bond_dict[int(bond[1])].append(int(bond[2]))
-        bond_dict[int(bond[2])].append(int(bond[1]))
-    return bond_dict
-
-
-def move_bonded_atoms(central_atom, morphology, bond_dict, box_dims):
-    for bonded_atom in bond_dict[central_atom]:
-        posn1 = np.array(list(map(float,
-                                  morphology['position_text'][central_atom])))
-        posn2 = np.array(list(map(float,
-                                  morphology['position_text'][bonded_atom])))
-        delta_position = posn1 - posn2
-        moved = False
-        for axis, value in enumerate(delta_position):
-            if value > box_dims[axis] / 2.0:
-                morphology['position_text'][bonded_atom][axis] = str(
-                    posn2[axis] + box_dims[axis])
-                moved = True
-            if value < -box_dims[axis] / 2.0:
-                morphology['position_text'][bonded_atom][axis] = str(
-                    posn2[axis] - box_dims[axis])
-                moved = True
-        if moved:
-            morphology = move_bonded_atoms(bonded_atom, morphology, bond_dict,
-                                           box_dims)
-    return morphology
+def get_bond_graph(morphology):
+    # Returns the bond graph in CSR form, such that the atoms bonded to atom_ID
+    # are bond_indices[bond_indptr[atom_ID]:bond_indptr[atom_ID + 1]]
+    n_atoms = len(morphology.positions)
+    bonds = morphology.bonds
+    # Each bond appears in the graph in both directions
+    edges = np.concatenate([bonds, bonds[:, ::-1]])
+    bond_order = np.argsort(edges[:, 0], kind='mergesort')
+    bond_indices = edges[bond_order, 1]
+    bond_indptr = np.concatenate([[0], np.cumsum(
+        np.bincount(edges[:, 0], minlength=n_atoms))])
+    return bond_indptr, bond_indices
+
+
+@njit(cache=True)
+def move_bonded_atoms(central_atom, atom_positions, bond_indptr,
+                      bond_indices, box_dims):
+    # Walk outwards from the central_atom over its whole molecule, putting
+    # each atom on the same periodic image as the bonded atom it was first
+    # reached from. The central_atom itself never moves.
+    # This is compiled with numba, so the atoms still to be checked are kept
+    # in a manually-managed stack rather than a deque. Each atom is only
+    # added to the stack once, so it never needs to grow.
+    visited = np.zeros(len(atom_positions), dtype=np.bool_)
+    atoms_to_check = np.empty(len(atom_positions), dtype=np.int64)
+    atoms_to_check[0] = central_atom
+    visited[central_atom] = True
+    n_to_check = 1
+    while n_to_check > 0:
+        n_to_check -= 1
+        current_atom = atoms_to_check[n_to_check]
+        for bond_index in range(bond_indptr[current_atom],
+                                bond_indptr[current_atom + 1]):
+            bonded_atom = bond_indices[bond_index]
+            if visited[bonded_atom]:
+                continue
+            visited[bonded_atom] = True
+            for axis in range(3):
+                # Rounding gives the number of box lengths the bonded atom has
+                # to move by to be within half a box length of the current
+                # atom, without branching on which side of the box it is
+                image_shift = np.rint((atom_positions[current_atom, axis]
+                                       - atom_positions[bonded_atom, axis])
+                                      / box_dims[axis])
+                atom_positions[bonded_atom, axis] += (image_shift
+                                                      * box_dims[axis])
+            atoms_to_check[n_to_check] = bonded_atom
+            n_to_check += 1
+    return atom_positions
 
 
 def load_morphology_xml(xml_file_name):
-    morphology_dictionary = OrderedDict()
+    morphology = hoomd_morphology()
+    # The outer two layers of the xml are the root and the config. Everything
+    # deeper than that is a child of config.
+    outer_layers = ['root', 'config']
+    depth = 0
     with open(xml_file_name, 'r') as xml_file:
-        xml_tree = ET.parse(xml_file)
-    root = xml_tree.getroot()
-    morphology_dictionary['root_tag'] = root.tag
-    morphology_dictionary['root_attrib'] = root.attrib
-    morphology_dictionary['root_text'] = root.text
-    for config in root:
-        morphology_dictionary['config_tag'] = config.tag
-        morphology_dictionary['config_attrib'] = config.attrib
-        morphology_dictionary['config_text'] = config.text
-        for child in config:
+        # Stream through the xml instead of building the whole tree first, so
+        # that each child can be parsed and then cleared straight away
+        for event, element in ET.iterparse(xml_file,
+                                           events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth < len(outer_layers):
+                # The text is only guaranteed to have been read by the end
+                # event, so store the outer layers here
+                layer = outer_layers[depth]
+                setattr(morphology, layer + '_tag', element.tag)
+                setattr(morphology, layer + '_attrib', element.attrib)
+                setattr(morphology, layer + '_text', element.text)
+                continue
+            if depth > len(outer_layers):
+                continue
+            child = element
+            if child.tag not in morphology.child_tags:
+                morphology.child_tags.append(child.tag)
             if len(child.attrib) > 0:
-                morphology_dictionary[child.tag + '_attrib'] = {
+                morphology.raw_data[child.tag + '_attrib'] = {
                     key.lower(): val for key, val in child.attrib.items()}
             else:
-                morphology_dictionary[child.tag + '_attrib'] = {}
-            if child.text is not None:
-                morphology_dictionary[child.tag + '_text'] = [
+                morphology.raw_data[child.tag + '_attrib'] = {}
+            if child.tag in ARRAY_TAGS:
+                attribute, dtype = ARRAY_TAGS[child.tag]
+                if (child.text is not None) and (len(child.text.strip()) > 0):
+                    array = np.fromstring(child.text, dtype=dtype, sep=' ')
+                else:
+                    array = np.zeros(0, dtype=dtype)
+                setattr(morphology, attribute, array.reshape(-1, 3))
+            elif child.text is not None:
+                morphology.raw_data[child.tag + '_text'] = [
                     x.split() for x in child.text.split('\n') if len(x) > 0]
             else:
-                morphology_dictionary[child.tag + '_text'] = []
-    return morphology_dictionary
-
-
-def check_wrapped_positions(input_dictionary):
-    box_dims = [float(input_dictionary['box_attrib'][axis]) for axis in
-                ['lx', 'ly', 'lz']]
-    atom_positions = np.array([np.array(list(map(float, _))) for _ in
-                               input_dictionary['position_text']])
-    atom_images = np.array([np.array(list(map(int, _))) for _ in
-                            input_dictionary['image_text']])
-    xhi = box_dims[0] / 2.0
-    xlo = -box_dims[0] / 2.0
-    yhi = box_dims[1] / 2.0
-    ylo = -box_dims[1] / 2.0
-    zhi = box_dims[2] / 2.0
-    zlo = -box_dims[2] / 2.0
-    for atom_ID in range(len(atom_positions)):
-        while atom_positions[atom_ID][0] > xhi:
-            atom_positions[atom_ID][0] -= box_dims[0]
-            atom_images[atom_ID][0] += 1
-        while atom_positions[atom_ID][0] < xlo:
-            atom_positions[atom_ID][0] += box_dims[0]
-            atom_images[atom_ID][0] -= 1
-        while atom_positions[atom_ID][1] > yhi:
-            atom_positions[atom_ID][1] -= box_dims[1]
-            atom_images[atom_ID][1] += 1
-        while atom_positions[atom_ID][1] < ylo:
-            atom_positions[atom_ID][1] += box_dims[1]
-            atom_images[atom_ID][1] -= 1
-        while atom_positions[atom_ID][2] > zhi:
-            atom_positions[atom_ID][2] -= box_dims[2]
-            atom_images[atom_ID][2] += 1
-        while atom_positions[atom_ID][2] < zlo:
-            atom_positions[atom_ID][2] += box_dims[2]
-            atom_images[atom_ID][2] -= 1
-    input_dictionary['position_text'] = list([list(map(str, _)) for _ in
-                                              atom_positions])
-    input_dictionary['image_text'] = list([list(map(str, _)) for _ in
-                                           atom_images])
-    return input_dictionary
-
-
-def write_morphology_xml(morphology_dictionary, output_file_name):
-    # morphology_dictionary is a bunch of keys with the tagnames given for
-    # both attributes and text: tag + '_attrib', tag + '_text'
-    # The only boilerplate bits are the 'root_tag', 'root_attrib', and
-    # 'root_text', which is (obviously) the outmost layer of the xml.
-    # Immediately inside are the 'config_tag', 'config_attrib', and
-    # 'config_text'. Everything else is a child of config.
-    morphology_dictionary = check_wrapped_positions(morphology_dictionary)
+                morphology.raw_data[child.tag + '_text'] = []
+            # The data has been extracted, so free up the element's memory
+            child.clear()
+    morphology.box = np.array([float(morphology.raw_data['box_attrib'][axis])
+                               for axis in ['lx', 'ly', 'lz']])
+    if len(morphology.raw_data.get('bond_text', [])) > 0:
+        morphology.bonds = np.array(
+            morphology.raw_data['bond_text'])[:, 1:3].astype(int)
+    return morphology
+
+
+def check_wrapped_positions(morphology):
+    box_dims = morphology.box
+    box_lo = -box_dims / 2.0
+    # Work out how many box lengths each atom is away from the central image
+    # along each axis, then shift all of the atoms back in one go (rather
+    # than stepping each atom back one box length at a time)
+    image_shift = np.floor((morphology.positions - box_lo) / box_dims)
+    morphology.positions -= image_shift * box_dims
+    morphology.images += image_shift.astype(int)
+    return morphology
+
+
+def write_morphology_xml(morphology, output_file_name):
+    # morphology is a hoomd_morphology. The root and config attributes are
+    # (obviously) the outer two layers of the xml, and everything else is a
+    # child of config.
+    # raw_data has keys with the tagnames given for both attributes and text:
+    # tag + '_attrib', tag + '_text'
+    # The tags in ARRAY_TAGS only have an attrib key, and their text comes
+    # from the corresponding morphology array.
+    morphology = check_wrapped_positions(morphology)
     # Build the xml tree.
-    root = ET.Element(morphology_dictionary['root_tag'],
-                      **morphology_dictionary['root_attrib'])
-    root.text = morphology_dictionary['root_text']
-    config = ET.Element(morphology_dictionary['config_tag'],
-                        **morphology_dictionary['config_attrib'])
-    config.text = morphology_dictionary['config_text']
-    # Find the remaining elements to make (set is easier here, but a
-    # disordered structure, so instead we use lists to keep the order
-    # consistent with reading in).
-    all_child_tags = ['_'.join(key.split('_')[:-1]) for key in
-                      morphology_dictionary.keys()
-                      if '_'.join(key.split('_')[:-1]) not in
-                      ['root', 'config']]
-    child_tags = []
-    for tag in all_child_tags:
-        # The list comprehension makes two blank entries for some reason and
-        # I can't work out why. This will just skip those two entries, as well
-        # as make the set.
-        if (tag not in child_tags) and (len(tag) > 0):
-            child_tags.append(tag)
-    for child_tag in child_tags:
-        child = ET.Element(child_tag,
-                           **morphology_dictionary[child_tag + '_attrib'])
-        if child_tag != "external_forcefields":
-            data_to_write = '\n'.join(['\t'.join(el) for el in
-                                       morphology_dictionary[
-                                           child_tag + '_text']])
+    root = xml_writer.Element(morphology.root_tag, **morphology.root_attrib)
+    root.text = morphology.root_text
+    config = xml_writer.Element(morphology.config_tag,
+                                **morphology.config_attrib)
+    config.text = morphology.config_text
+    # The remaining elements to make are listed in child_tags, in the same
+    # order that they were read in.
+    for child_tag in morphology.child_tags:
+        child_attrib = morphology.raw_data[child_tag + '_attrib']
+        child = xml_writer.Element(child_tag, **child_attrib)
+        if child_tag in ARRAY_TAGS:
+            array = getattr(morphology, ARRAY_TAGS[child_tag][0])
+            array_buffer = io.StringIO()
+            np.savetxt(array_buffer, array, delimiter='\t',
+                       fmt='%d' if array.dtype.kind == 'i' else '%.8f')
+            data_to_write = array_buffer.getvalue().rstrip('\n')
+        elif child_tag != "external_forcefields":
+            # Join the rows with map rather than building an intermediate
+            # list of row strings
+            data_to_write = '\n'.join(map('\t'.join, morphology.raw_data[
+                child_tag + '_text']))
         else:
-            data_to_write = '\n'.join([el for el in morphology_dictionary[child_tag + "_text"]])
+            data_to_write = '\n'.join(morphology.raw_data[child_tag + "_text"])
         if len(data_to_write) > 0:
             child.text = '\n' + data_to_write + '\n'
         child.tail = '\n'
         config.append(child)
     root.insert(0, config)
-    tree = ET.ElementTree(root)
+    tree = xml_writer.ElementTree(root)
     tree.write(output_file_name, xml_declaration=True, encoding='UTF-8')
     print("XML file written to", str(output_file_name) + "!")
 
 
-def rename_crystal_types(input_dictionary, AAIDs):
+def rename_crystal_types(morphology, AAIDs):
     for atom_index in AAIDs:
-        previous_type = input_dictionary['type_text'][atom_index][0]
-        input_dictionary['type_text'][atom_index] = ['X_' + previous_type]
-    return input_dictionary
+        previous_type = morphology.raw_data['type_text'][atom_index][0]
+        morphology.raw_data['type_text'][atom_index] = ['X_' + previous_type]
+    return morphology
 
 
 def fix_images(file_name):
@@ -643,10 +897,8 @@ def fix_images(file_name):
           " the box...")
     morphology = load_morphology_xml(file_name)
     morphology = zero_out_images(morphology)
-    bond_dict = get_bond_dict(morphology)
-    box_dims = [float(morphology['box_attrib'][axis]) for axis in
-                ['lx', 'ly', 'lz']]
-    morphology = check_bonds(morphology, bond_dict, box_dims)
+    bond_indptr, bond_indices = get_bond_graph(morphology)
+    morphology = check_bonds(morphology, bond_indptr, bond_indices)
     return morphology
 
 
@@ -682,11 +934,14 @@ def create_output_file_name(args, file_type='hoomdxml'):
         return 'output.hoomdxml'
     else:
         output_file = "out"
-        for (arg_name, arg_val) in sorted(args._get_kwargs()):
-            try:
-                if (arg_val == defaults_dict[arg_name]):
-                    continue
-            except KeyError:
+        args_dict = vars(args)
+        # Only the arguments in defaults_dict go into the name, so walk those
+        # rather than sorting and looking up every argument that was parsed
+        for (arg_name, default_val) in SORTED_DEFAULTS:
+            if arg_name not in args_dict:
+                continue
+            arg_val = args_dict[arg_name]
+            if arg_val == default_val:
                 continue
             output_file += "-"
             if arg_name == "stoichiometry":
@@ -858,8 +1113,10 @@ def main():
                         This only makes sense for a small number of reactant
                         particles (i.e. nanoparticle initializations).
                         For example: -rp [[-50, 0, 50], [50, 0, 50]].\n
-                        If unspecified, then reactants will be packed randomly
-                        using packmol.
+                        If unspecified, then a single reactant species will be
+                        placed on a randomly-jittered grid (keeping the
+                        orientation of the template) if it fits, otherwise
+                        reactants will be packed randomly using packmol.
                         ''')
     parser.add_argument("--gecko",
                         action='store_true',
@@ -940,6 +1197,18 @@ def main():
                         0.400321 nm. (Taken from Desanto2006
                         (10.1007/s11244-006-0068-8))\n
                         For example: -xz 0.400321.\n''')
+    parser.add_argument("-np", "--n_processes",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='''Set the number of processes to use when
+                        creating the unit cells of the crystal surfaces.\n
+                        The unit cells are independent of each other, so for
+                        large surfaces (-d) they can be created in parallel
+                        before being bonded together.\n
+                        For example: -np 4.\n
+                        If unspecified, the unit cells are created in
+                        serial.''')
     args = parser.parse_args()
     if args.gecko:
         print(zlib.decompress(base64.decodebytes(